@@ -11,9 +11,17 @@ Sections:
     .mem    - Memory/frontier initialization
 '''
 
+import array
+import functools
+import hashlib
+import mmap
+import os
 import re
+import shutil
+import stat
 import struct
 import sys
+from pathlib import Path
 
 OPCODE_ARG_MASK         = 0x000000FF 
 REGISTER_ARG_MASK       = 0x000000FF 
@@ -21,6 +29,13 @@ IMMEDIATE_ARG_MASK      = 0xFFFFFFFF
 FLAG_I                  = 0x00000001
 FLAG_F                  = 0x00000002
 
+# Flags already shifted into the flags field (bits 48-55)
+_FI48                   = FLAG_I << 48
+_FF48                   = FLAG_F << 48
+
+# Integer literal parser, allows decimal or hex
+_parse_int = functools.partial(int, base=0)
+
 register_names = {
     'Rnode': 0,
     'Rnbr': 1,
@@ -62,194 +77,298 @@ register_names = {
     'Fzero': 37,
 }
 
+# First float register, float register indexes are encoded relative to it
+_F1 = register_names['f1']
+
+# Register class of every encodable register index, None for unassigned indexes
+_REG_TYPE = tuple(
+    'r' if register_names['Rnode'] <= reg <= register_names['Rcore'] else
+    'f' if register_names['f1'] <= reg <= register_names['Fzero'] else
+    None
+    for reg in range(REGISTER_ARG_MASK + 1)
+)
+
+# Index rebase and shifted float flag of every register index, float registers are encoded relative to f1
+_REG_BASE = tuple(_F1 if rtype == 'f' else 0 for rtype in _REG_TYPE)
+_REG_FLAGS = tuple(_FF48 if rtype == 'f' else 0x0 for rtype in _REG_TYPE)
+
 def reg_type(reg):
-    if reg >= register_names['Rnode'] and reg <= register_names['Rcore']:
-        return 'r'
-    if reg >= register_names['f1'] and reg <= register_names['Fzero']:
-        return 'f'
+    return _REG_TYPE[reg]
+
+# Prebuilt packer so float immediates skip the format string lookup
+_PACK_F32 = struct.Struct('<f').pack
+
+def float_to_bits(value):
+    '''Reinterpret a float as the bits of a 32 bit IEEE 754 single'''
+    return int.from_bytes(_PACK_F32(value), 'little')
+
+# Operand tags, operands reach the encoders as (tag, value) pairs
+ARG_REG = 0     # Register index
+ARG_IMM = 1     # Immediate, literal text or resolved label address
+
+def classify_operand(token):
+    '''Tag a literal operand, '#' marks an immediate and bare numbers are register indexes'''
+    if token.startswith('#'):
+        return ARG_IMM, token[1:]
+    return ARG_REG, int(token)
+
+def _register(arg):
+    '''Register index of an operand'''
+    tag, value = arg
+    if tag != ARG_REG:
+        raise ValueError(f'Expected a register, got #{value}')
+    return value & REGISTER_ARG_MASK
+
+def _immediate(arg):
+    '''Integer value of an immediate operand'''
+    tag, value = arg
+    if tag != ARG_IMM:
+        raise ValueError(f'Expected an immediate, got register {value}')
+    return int(value) & IMMEDIATE_ARG_MASK
 
 '''=== Instruction Encoding ====================================================='''
 
+# Operand kinds, selects the encoder used for an opcode
+NOARG   = 0     # No arguments
+I       = 1     # Immediate
+RRR_I   = 2     # Register, register, register or immediate
+RR_I    = 3     # Register, register or immediate
+R       = 4     # Register
+
 OPCODES = {
-    'HALT': 0,      # End of program
-    'BZ': 1,        # Conditional branch if zero
-    'BNZ': 2,       # Conditional branch if not zero
-    'BLT': 3,       # Branch if less than
-    'BGE': 4,       # Branch if greater than equal to
-    'JMP': 5,       # Unconditional jump
-    'NITER': 6,     # Initialize neighbor iteration
-    'NNEXT': 7,     # Load next neighbor into Rnbr
-    'EITER': 8,     # Initialize edge iteration     
-    'ENEXT': 9,     # Load next edge into Rnode, Rnbr, Rval
-    'HASE': 10,     # Check if there is an edge between Rnode and input node
-    'DEG': 11,      # Store the degree of a node in a register
-    'ADD': 12,      # Add registers
-    'SUB': 13,      # Subtract registers
-    'MUL': 14,      # Multiply registers
-    'DIV': 15,      # Divide two registers
-    'CMP': 16,      # Compare, set FLAGS
-    'MOV': 17,      # Move
-    'MOVC': 18,     # Cast a register to a float register
-    'LD': 19,       # Load register from memory
-    'ST': 20,       # Store register to memory
-    'FPUSH': 21,    # Add neighbor to next frontier
-    'FPOP': 22,     # Load next node from frontier
-    'FEMPTY': 23,   # Check if frontier is empty
-    'FSWAP': 24,    # Swap next frontier and current frontier buffers
-    'FFILL': 25,    # Fill the frontier with all nodes in graph
-    # 'PARALLEL': , # Run next block of code with multicore mode
-    # 'BARRIER': ,  # Wait until all cores reach this code before continuing
-    # 'LOCK': ,     # Mutual exclusion lock on a resource
-    # 'UNLOCK': ,   # Unlock mutual exclusion lock
+    'HALT': (0, NOARG),     # End of program
+    'BZ': (1, I),           # Conditional branch if zero
+    'BNZ': (2, I),          # Conditional branch if not zero
+    'BLT': (3, I),          # Branch if less than
+    'BGE': (4, I),          # Branch if greater than equal to
+    'JMP': (5, I),          # Unconditional jump
+    'NITER': (6, I),        # Initialize neighbor iteration
+    'NNEXT': (7, I),        # Load next neighbor into Rnbr
+    'EITER': (8, NOARG),    # Initialize edge iteration     
+    'ENEXT': (9, NOARG),    # Load next edge into Rnode, Rnbr, Rval
+    'HASE': (10, NOARG),    # Check if there is an edge between Rnode and input node
+    'DEG': (11, R),         # Store the degree of a node in a register
+    'ADD': (12, RRR_I),     # Add registers
+    'SUB': (13, RRR_I),     # Subtract registers
+    'MUL': (14, RRR_I),     # Multiply registers
+    'DIV': (15, RRR_I),     # Divide two registers
+    'CMP': (16, RR_I),      # Compare, set FLAGS
+    'MOV': (17, RR_I),      # Move
+    'MOVC': (18, RR_I),     # Cast a register to a float register
+    'LD': (19, RR_I),       # Load register from memory
+    'ST': (20, RR_I),       # Store register to memory
+    'FPUSH': (21, R),       # Add neighbor to next frontier
+    'FPOP': (22, R),        # Load next node from frontier
+    'FEMPTY': (23, NOARG),  # Check if frontier is empty
+    'FSWAP': (24, NOARG),   # Swap next frontier and current frontier buffers
+    'FFILL': (25, NOARG),   # Fill the frontier with all nodes in graph
+    # 'PARALLEL': (, NOARG),    # Run next block of code with multicore mode
+    # 'BARRIER': (, NOARG),     # Wait until all cores reach this code before continuing
+    # 'LOCK': (, I),            # Mutual exclusion lock on a resource
+    # 'UNLOCK': (, I),          # Unlock mutual exclusion lock
 }
 
+def _encode_noarg(opcode, args):
+    '''No argument operations'''
+    return opcode
+
+def _encode_i(opcode, args):
+    '''I operations, the immediate flag is already folded into opcode'''
+    imm = _immediate(args[0])
+    return opcode | imm
+
+def _parse_op3(arg, is_float):
+    '''Split the third operand into its low 32 bits and its shifted immediate flag'''
+    tag, value = arg
+    if tag == ARG_IMM:
+        value = float_to_bits(float(value)) if is_float else int(value)
+        return value & IMMEDIATE_ARG_MASK, _FI48
+
+    # Register operands live in the top 8 bits of the immediate field
+    base = _F1 if is_float else 0
+    return ((value - base) & REGISTER_ARG_MASK) << 24, 0x0
+
+def _encode_rrr(opcode, args):
+    '''R-R-R/I operations'''
+    r0 = _register(args[0])
+    r1 = _register(args[1])
+
+    if reg_type(r0) is None:
+        raise ValueError('Invalid register')
+
+    # Float instructions rebase their registers and set FLAG_F, straight from the tables
+    base = _REG_BASE[r0]
+    flags = _REG_FLAGS[r0]
+    r0 -= base
+    r1 -= base
+
+    # Register or immediate third operand, the immediate flag is ORed straight in
+    r2, imm_flag = _parse_op3(args[2], flags)
+
+    return opcode | flags | imm_flag | (r0 << 40) | (r1 << 32) | r2
+
+def _encode_rr(opcode, args):
+    '''R-R/I operations'''
+    r0 = _register(args[0])
+    tag, value = args[1]
+
+    if reg_type(r0) is None:
+        raise ValueError('Invalid register')
+
+    # Float instructions rebase the destination and set FLAG_F, straight from the tables
+    flags = _REG_FLAGS[r0]
+    r0 -= _REG_BASE[r0]
+
+    # Check for immediate instruction
+    if tag == ARG_IMM:
+        # Float destinations take the IEEE bits of the immediate
+        r1 = (float_to_bits(float(value)) if flags else int(value)) & IMMEDIATE_ARG_MASK
+        flags |= _FI48
+    else:
+        # Float instructions rebase the source by its own register class
+        r1 = value & REGISTER_ARG_MASK
+        if flags:
+            r1 -= _REG_BASE[r1]
+        r1 = (r1 & REGISTER_ARG_MASK) << 32
+
+    return opcode | flags | (r0 << 40) | r1
+
+def _encode_r(opcode, args):
+    '''R operations'''
+    r = _register(args[0])
+    return opcode | (r << 40)
+
+_KIND_ENCODERS = {
+    NOARG: _encode_noarg,
+    I: _encode_i,
+    RRR_I: _encode_rrr,
+    RR_I: _encode_rr,
+    R: _encode_r,
+}
+
+# Flags every instruction of a kind carries, folded into the bound opcode
+_KIND_FLAGS = {I: _FI48}
+
+# Opcode -> encoder with the shifted opcode (and constant flags) already bound, built once at import
+HANDLERS = {
+    op: functools.partial(_KIND_ENCODERS[kind], (value << 56) | _KIND_FLAGS.get(kind, 0x0))
+    for op, (value, kind) in OPCODES.items()
+}
+
+# No argument operations encode to a constant, looked up without calling an encoder
+NOARG_ENCODING = {op: value << 56 for op, (value, kind) in OPCODES.items() if kind == NOARG}
+
+@functools.lru_cache(maxsize=4096)
 def encode_instruction(op, args):
     '''
-    Encode an instruction to 64 bits.
+    Encode an instruction to 64 bits, args must be a hashable tuple of operands.
+    Results are memoized since programs repeat the same instructions often.
     Simplified encoding:
         [ 8 bit opcode | 8 bit flags | 8 bit dst | 8 bit src1 | 32 bit imm (top 8 used for register) ]
     '''
-    opcode = OPCODES[op] << 56
-
-    # No argument operations
-    if op in ['HALT', 'EITER', 'ENEXT', 'FEMPTY', 'FSWAP', 'HASE', 'FFILL', 'PARALLEL', 'BARRIER']:
-        return opcode
-    
-    # I operations
-    elif op in ['BZ', 'BNZ', 'BLT', 'BGE', 'JMP', 'NITER', 'NNEXT', 'LOCK', 'UNLOCK']:
-        imm = int(args[0][1:]) & IMMEDIATE_ARG_MASK
-        return opcode | (FLAG_I << 48) | imm
-    
-    # R-R-R/I operations
-    elif op in ['ADD', 'SUB', 'MUL', 'DIV']:
-        r0 = int(args[0]) & REGISTER_ARG_MASK
-        r1 = int(args[1]) & REGISTER_ARG_MASK
-
-        rtype = reg_type(r0)
-        
-        # Check for immediate instruction
-        if args[2].startswith('#'):
-            # Check for float instruction
-            if rtype == 'f':
-                # Set the correct register indexes
-                r0 -= register_names['f1']
-                r1 -= register_names['f1']
-
-                # Set immediate value and flags
-                r2 = struct.unpack('<I', struct.pack('<f', float(args[2][1:])))[0] & IMMEDIATE_ARG_MASK
-                flags = FLAG_I | FLAG_F
-            elif rtype == 'r':
-                r2 = int(args[2][1:]) & IMMEDIATE_ARG_MASK
-                flags = FLAG_I
-            else:
-                raise ValueError('Invalid register')
-        else:
-            # Check for float instruction
-            if rtype == 'f':
-                # Set the correct register indexes
-                r0 -= register_names['f1']
-                r1 -= register_names['f1']
-
-                # Set correct register index and flags
-                r2 = ((int(args[2]) - register_names['f1']) & REGISTER_ARG_MASK) << 24
-                flags = FLAG_F
-            elif rtype == 'r':
-                r2 = (int(args[2]) & REGISTER_ARG_MASK) << 24
-                flags = 0x0
-            else:
-                raise ValueError('Invalid register')
-
-        return opcode | (flags << 48) | (r0 << 40) | (r1 << 32) | r2
-    
-    # R-R/I integer operations
-    elif op in ['MOV', 'CMP', 'MOVC', 'LD', 'ST']:
-        r0 = int(args[0]) & REGISTER_ARG_MASK
-
-        rtype = reg_type(r0)
-
-        # Check for immediate instruction
-        if args[1].startswith('#'):
-            # Check for float instruction
-            if rtype == 'f':
-                # Set the correct register indexes
-                r0 -= register_names['f1']
-
-                # Set immediate value and flags
-                r1 = struct.unpack('<I', struct.pack('<f', float(args[1][1:])))[0] & IMMEDIATE_ARG_MASK
-                flags = FLAG_I | FLAG_F
-            elif rtype == 'r' or rtype == 'm':
-                r1 = int(args[1][1:]) & IMMEDIATE_ARG_MASK
-                flags = FLAG_I
-            else:
-                raise ValueError('Invalid register')
-        else:
-            # Check for float instruction
-            if rtype == 'f':
-                # Set the correct register indexes
-                r0 -= register_names['f1']
-                r1 = int(args[1])
-                if reg_type(r1) == 'f':
-                    r1 -= register_names['f1']
-
-                r1 = (r1 & REGISTER_ARG_MASK) << 32
-                flags = FLAG_F
-            elif rtype == 'r' or rtype == 'm':
-                r1 = (int(args[1]) & REGISTER_ARG_MASK) << 32
-                flags = 0x0
-            else:
-                raise ValueError('Invalid register')
-
-        return opcode | (flags << 48) | (r0 << 40) | r1
-
-    # R operations
-    elif op in ['FPUSH', 'FPOP', 'DEG']:
-        r = int(args[0]) & REGISTER_ARG_MASK
-        return opcode | (r << 40)
-
-    # Invalid opcode
-    else:
-        raise ValueError(f'Unkown opcode: {op}')
+    word = NOARG_ENCODING.get(op)
+    if word is not None:
+        return word
+
+    try:
+        encoder = HANDLERS[op]
+    except KeyError:
+        raise ValueError(f'Unknown opcode: {op}') from None
+    return encoder(args)
     
-'''=== Assembler Parser ====================================================================='''
-
-def parse_assembly(lines):
-    section = None
-    code = []
-    data = {'row_index': [], 'col_index': [], 'values': []}
-    mem = []
-
-    code_labels = {}
+'''=== Peephole Optimizer ==================================================================='''
+
+_ADD, _SUB, _MUL, _DIV, _MOV = (OPCODES[op][0] for op in ('ADD', 'SUB', 'MUL', 'DIV', 'MOV'))
+_FSWAP = NOARG_ENCODING['FSWAP']
+
+# Operations whose immediate is a PC address, literal '#n' targets are remapped like labels
+BRANCH_OPS = frozenset(('BZ', 'BNZ', 'BLT', 'BGE', 'JMP'))
+
+_UNPACK_F32 = struct.Struct('<f').unpack
+
+def _is_noop(word):
+    '''Check for an instruction that leaves every register, flag and memory cell unchanged'''
+    opcode = (word >> 56) & OPCODE_ARG_MASK
+    flags = (word >> 48) & 0xFF
+    dst = (word >> 40) & REGISTER_ARG_MASK
+    src = (word >> 32) & REGISTER_ARG_MASK
+    imm = word & IMMEDIATE_ARG_MASK
+
+    if dst != src:
+        return False
+
+    # ADD r, r, #0 / SUB r, r, #0 / MUL r, r, #1 / DIV r, r, #1 (integer only, arithmetic sets no flags)
+    if flags == FLAG_I:
+        if opcode == _ADD or opcode == _SUB:
+            return imm == 0
+        if opcode == _MUL or opcode == _DIV:
+            return imm == 1
+
+    # MOV r, r
+    return opcode == _MOV and not flags & FLAG_I
+
+def _ref_address(word):
+    '''Address in the immediate of an instruction, float instructions hold it as IEEE bits'''
+    imm = word & IMMEDIATE_ARG_MASK
+    if (word >> 48) & FLAG_F:
+        return int(_UNPACK_F32(imm.to_bytes(4, 'little'))[0])
+    return imm
+
+def _with_address(word, address):
+    '''Replace the address in the immediate of an instruction'''
+    imm = float_to_bits(float(address)) if (word >> 48) & FLAG_F else address
+    return (word & ~IMMEDIATE_ARG_MASK) | (imm & IMMEDIATE_ARG_MASK)
+
+def peephole(code, label_refs):
+    '''
+    Drop instructions that have no effect and cancel back to back FSWAP pairs.
+    label_refs holds the indexes of instructions whose immediate is an address (labels
+    and literal branch targets), those addresses are remapped to account for the removed instructions.
+    '''
+    # Addresses referenced, a FSWAP that is a branch target cannot be cancelled
+    targets = {_ref_address(code[i]) for i in label_refs}
+
+    keep = [True] * len(code)
+    i = 0
+    while i < len(code):
+        if _is_noop(code[i]):
+            keep[i] = False
+        elif code[i] == _FSWAP and i + 1 < len(code) and code[i + 1] == _FSWAP and i + 1 not in targets:
+            keep[i] = keep[i + 1] = False
+            i += 1
+        i += 1
+
+    if all(keep):
+        return code
+
+    # New address of every old address, removed instructions fall through to the next kept one
+    new_address = []
     pc = 0
+    for kept in keep:
+        new_address.append(pc)
+        pc += kept
+    new_address.append(pc)
 
-    # First pass (Resolve labels)
-    for line in lines:
-        # Remove comments
-        line = re.sub(r';.*$', '', line)
+    # Addresses past the end of the program shift down by the number of removed instructions
+    removed = len(code) - pc
+    for i in label_refs:
+        if keep[i]:
+            address = _ref_address(code[i])
+            address = new_address[address] if address < len(new_address) else address - removed
+            code[i] = _with_address(code[i], address)
 
-        # Remove empty spaces
-        line = line.strip()
+    return array.array('Q', (word for word, kept in zip(code, keep) if kept))
 
-        if not line:
-            # Blank line or comment
-            continue
-
-        if line.startswith('.'):
-            section = line
-            continue
-
-        if section == '.code':
-            if line.endswith(':'):
-                code_labels[line[:-1]] = pc
-            else:
-                pc += 1
+'''=== Assembler Parser ====================================================================='''
 
-    # Second pass (Parse assembly)
+def tokenize_lines(lines):
+    '''
+    Clean and tokenize every source line exactly once.
+    Yields (kind, tokens) where kind is 'section', 'label' or 'tokens'.
+    '''
     for line in lines:
-        # Remove comments 
-        line = re.sub(r';.*$', '', line)
-
-        # Remove empty spaces 
-        line = line.strip()
+        # Remove comments and empty spaces
+        line = line.partition(';')[0].strip()
 
         if not line:
             # Blank line or comment
@@ -257,91 +376,280 @@ def parse_assembly(lines):
 
         if line.startswith('.'):
             # Section heading
-            section = line
-            continue
-
-        if section == '.code':
-            # Code section, instructions
-
-            if line.endswith(':'):
-                # Label symbols
-                continue
-
-            tokens = re.split(r'[,\s]+', line)
-            op = tokens[0]
-            args = tokens[1:]
-
-            # Substitute Register names and label names
-            for i in range(len(args)):
-                if args[i] in register_names:
-                    args[i] = str(register_names[args[i]])
-                elif args[i] in code_labels:
-                    args[i] = '#' + str(code_labels[args[i]])
-
-            code.append(encode_instruction(op, args))
-
-        elif section == '.row_index':
-            # Break up section into values
-            tokens = re.split(r'[,\s]+', line)
-            for token in tokens:
-                # Allow decimal or hex
-                data['row_index'].append(int(token, 0))
-        
-        elif section == '.col_index':
-            # Break up section into values
-            tokens = re.split(r'[,\s]+', line)
-            for token in tokens:
-                # Allow decimal or hex
-                data['col_index'].append(int(token, 0))
-
-        elif section == '.values':
-            # Break up section into values
-            tokens = re.split(r'[,\s]+', line)
-            for token in tokens:
-                # Allow decimal or hex
-                data['values'].append(int(token, 0))
-
-        elif section == '.mem':
-            tokens = re.split(r'[,\s]+', line)
-            for token in tokens:
-                # Allow decimal or hex
-                if token.endswith('f'):
-                    mem.append(float(token, 0))
-                else:
-                    mem.append(int(token, 0))
+            yield 'section', [line]
+        elif line.endswith(':'):
+            # Label symbols
+            yield 'label', [line[:-1]]
+        else:
+            # Operands are separated by commas and/or whitespace
+            yield 'tokens', line.replace(',', ' ').split()
+
+# Tokens where plain int() and int(token, 0) can disagree: leading zeros ('010') and underscores ('0_10')
+_NOT_BASE0 = re.compile(r'_|(?<![0-9A-Za-z])0[0-9]')
+
+def _parse_ints(tokens):
+    '''Convert a line of integer tokens like int(token, 0), plain decimal first and decimal or hex as a fallback'''
+    if not _NOT_BASE0.search(' '.join(tokens)):
+        try:
+            return list(map(int, tokens))
+        except ValueError:
+            pass
+    return list(map(_parse_int, tokens))
+
+def _parse_mem(token):
+    '''
+    Memory words are decimal or hex integers, or floats with an 'f' suffix.
+    Floats are stored as their IEEE 754 bits so they fit the signed 32 bit memory words.
+    '''
+    try:
+        return int(token, 0)
+    except ValueError:
+        # Hex words may end in 'f' too, so floats are only tried once the integer parse fails
+        if not token.endswith('f'):
+            raise
+        return int.from_bytes(_PACK_F32(float(token[:-1])), 'little', signed=True)
+
+def _int_section(values):
+    '''Section handler that appends every token of a line to values'''
+    def handle(kind, tokens):
+        values.extend(_parse_ints(tokens))
+    return handle
+
+def parse_assembly(lines, optimize=False):
+    # Encoded words and data words are stored unboxed, 8 and 4 bytes each
+    code = array.array('Q')
+    data = {'row_index': array.array('i'), 'col_index': array.array('i'), 'values': array.array('i')}
+    mem = array.array('i')
+
+    # Register names resolve to register operands, label names to immediate addresses
+    symbols = {name: (ARG_REG, reg) for name, reg in register_names.items()}
+
+    # Forward label references, re-encoded once every label is known: [(code index, op, args, [(arg index, label)])]
+    patches = []
+
+    # Indexes of every instruction with an address in its immediate, remapped by the peephole pass
+    label_refs = set()
+
+    # Bind the per-instruction calls to locals so the handler skips global and attribute lookups
+    encode = encode_instruction
+    lookup = symbols.get
+
+    def code_section(kind, tokens):
+        '''Code section, instructions'''
+        if kind == 'label':
+            # Label symbols, labels share the symbol table with registers so neither may be redefined
+            label = tokens[0]
+            if label in register_names:
+                raise ValueError(f'Label shadows a register name: {label}')
+            if label in symbols:
+                raise ValueError(f'Duplicate label: {label}')
+            symbols[label] = (ARG_IMM, len(code))
+            return
+
+        # Interned so the handler lookup hits the identity fast path
+        op = sys.intern(tokens[0])
+
+        # Substitute Register names and label names, tag everything else
+        args = []
+        labels = []
+        for i, token in enumerate(tokens[1:]):
+            arg = lookup(token)
+            if arg is None:
+                try:
+                    arg = classify_operand(token)
+                    if arg[0] == ARG_IMM and op in BRANCH_OPS:
+                        # Literal branch target
+                        label_refs.add(len(code))
+                except ValueError:
+                    # Neither '#' immediate nor numeric, a label not defined yet.
+                    # Encode a zero address for now and re-encode once the label is known
+                    labels.append((i, token))
+                    arg = (ARG_IMM, 0)
+            elif arg[0] == ARG_IMM:
+                label_refs.add(len(code))
+            args.append(arg)
+
+        if labels:
+            patches.append((len(code), op, args, labels))
+            label_refs.add(len(code))
+        code.append(encode(op, tuple(args)))
+
+    def mem_section(kind, tokens):
+        '''Memory initialization'''
+        mem.extend(map(_parse_mem, tokens))
+
+    # Section heading -> line handler, lines in unknown sections are ignored
+    handlers = {
+        '.code': code_section,
+        '.row_index': _int_section(data['row_index']),
+        '.col_index': _int_section(data['col_index']),
+        '.values': _int_section(data['values']),
+        '.mem': mem_section,
+    }
+    handler = None
+
+    # Single pass (forward labels are back-patched at the end)
+    for kind, tokens in tokenize_lines(lines):
+        if kind == 'section':
+            # Section heading
+            handler = handlers.get(tokens[0])
+        elif handler is not None:
+            handler(kind, tokens)
+
+    # Re-encode forward label references, float destinations take the address as IEEE bits
+    for index, op, args, labels in patches:
+        for i, label in labels:
+            arg = symbols.get(label)
+            if arg is None:
+                raise ValueError(f'Undefined label: {label}')
+            args[i] = arg
+        code[index] = encode(op, tuple(args))
+
+    # Remove instructions with no effect, only when asked for since it changes the program
+    if optimize:
+        code = peephole(code, label_refs)
                 
     return code, data, mem
 
 '''=== Binary Output ========================================================================'''
 
-def write_binary(filename, code, data, mem):
-    with open(filename, 'wb') as f:
-        # Header: sizes (each 4 bytes)
-        f.write(struct.pack('<IIIII', len(code), len(data['row_index']), len(data['col_index']), len(data['values']), len(mem)))
-
-        # Sections
-        for word in code:
-            f.write(struct.pack('<Q', word))
+def _le_bytes(typecode, values):
+    '''Pack a whole section of integers into little endian bytes in one call'''
+    words = array.array(typecode, values)
+    if sys.byteorder == 'big':
+        words.byteswap()
+    return words.tobytes()
 
-        for section in (data['row_index'], data['col_index'], data['values'], mem):
-            for word in section:
-                f.write(struct.pack('<i', word))
+# Header: five 4 byte section sizes
+_HEADER = struct.Struct('<IIIII')
 
+def print_summary(filename, sizes):
+    '''Report an assembled binary from its header section sizes'''
+    n_code, n_row, n_col, n_values, n_mem = sizes
     print(f'[OK] Assembled {filename}')
-    print(f'    Code: {len(code)} instrs | Row Index: {len(data["row_index"])} words | Column Index: {len(data["col_index"])} words | Values: {len(data["values"])} words | Mem: {len(mem)} bytes')
+    print(f'    Code: {n_code} instrs | Row Index: {n_row} words | Column Index: {n_col} words | Values: {n_values} words | Mem: {n_mem} bytes')
+
+def _is_regular_file(filename):
+    '''Check whether the output is, or will be created as, a regular file'''
+    try:
+        return stat.S_ISREG(os.stat(filename).st_mode)
+    except FileNotFoundError:
+        return True
+
+def write_binary(filename, code, data, mem):
+    '''Write the binary and return the header and section bytes that were written'''
+    sections = [_le_bytes('Q', code)]
+    for section in (data['row_index'], data['col_index'], data['values'], mem):
+        sections.append(_le_bytes('i', section))
+
+    sizes = (len(code), len(data['row_index']), len(data['col_index']), len(data['values']), len(mem))
+    chunks = [_HEADER.pack(*sizes)] + sections
+
+    # Size the output file once
+    total = sum(len(chunk) for chunk in chunks)
+
+    if not _is_regular_file(filename):
+        # Devices and pipes cannot be resized or mapped, write everything in one call
+        with open(filename, 'wb') as f:
+            f.write(b''.join(chunks))
+        print_summary(filename, sizes)
+        return chunks
+
+    # Write straight into the mapped file instead of staging a copy in memory
+    with open(filename, 'w+b') as f:
+        f.truncate(total)
+        with mmap.mmap(f.fileno(), total) as out:
+            # Copy the header and sections in back to back
+            offset = 0
+            for chunk in chunks:
+                out[offset:offset + len(chunk)] = chunk
+                offset += len(chunk)
+
+    print_summary(filename, sizes)
+    return chunks
+
+'''=== Build Cache =========================================================================='''
+
+# Assembled binaries keyed by source hash, set GRAPHX_NO_CACHE to bypass
+CACHE_DIR = Path(os.environ.get('XDG_CACHE_HOME', Path.home() / '.cache')) / 'graphx'
+
+def cache_path(source, optimize):
+    '''Cache entry for a source file, keyed on the source, the options and on this assembler'''
+    digest = hashlib.sha256()
+    with open(__file__, 'rb') as f:
+        digest.update(f.read())
+    digest.update(b'-O' if optimize else b'--')
+    digest.update(source)
+    return CACHE_DIR / f'{digest.hexdigest()}.bin'
+
+def _section_bytes(sizes):
+    '''Size of a binary from its header section sizes, code words are 8 bytes and data words 4'''
+    n_code, *n_words = sizes
+    return _HEADER.size + 8*n_code + 4*sum(n_words)
+
+def cached_sizes(cached):
+    '''Header section sizes of a cache entry, None when it is missing, truncated or corrupt'''
+    try:
+        with open(cached, 'rb') as f:
+            header = f.read(_HEADER.size)
+            size = os.fstat(f.fileno()).st_size
+    except OSError:
+        return None
+
+    if len(header) < _HEADER.size:
+        return None
+    sizes = _HEADER.unpack(header)
+    return sizes if size == _section_bytes(sizes) else None
+
+def store_cache(chunks, cached):
+    '''Write the assembled header and section bytes into the cache, caching is best effort'''
+    try:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+
+        # Write to a temporary file first so readers never see a partial entry
+        tmp = cached.with_suffix(f'.{os.getpid()}.tmp')
+        with open(tmp, 'wb') as f:
+            f.writelines(chunks)
+        os.replace(tmp, cached)
+    except OSError:
+        pass
 
 '''=== Main ================================================================================='''
 
 def main():
-    if len(sys.argv) < 3:
-        print('Usage asm.py <input.graphx> <output.bin>')
+    # -O enables the peephole pass
+    args = sys.argv[1:]
+    optimize = '-O' in args
+    if optimize:
+        args.remove('-O')
+
+    if len(args) < 2:
+        print('Usage asm.py [-O] <input.graphx> <output.bin>')
         sys.exit(1)
+    source_file, output_file = args[0], args[1]
+
+    # Read the whole source in one go
+    with open(source_file, 'rb') as f:
+        source = f.read()
+
+    # Unchanged sources are copied straight from the cache, the summary comes from the cached header.
+    # Entries too short to hold what their header describes are treated as misses
+    cached = None if os.environ.get('GRAPHX_NO_CACHE') else cache_path(source, optimize)
+    sizes = None if cached is None else cached_sizes(cached)
+    if sizes is not None:
+        shutil.copyfile(cached, output_file)
+        print_summary(output_file, sizes)
+        return
+
+    # Split into lines without the trailing newlines
+    lines = source.decode('ascii', 'replace').splitlines()
 
-    with open(sys.argv[1], 'r') as f:
-        lines = f.readlines()
+    code, data, mem = parse_assembly(lines, optimize)
+    chunks = write_binary(output_file, code, data, mem)
 
-    code, data, mem = parse_assembly(lines)
-    write_binary(sys.argv[2], code, data, mem)
+    # Cache from the bytes just written, outputs that are not plain files are not cached
+    if cached is not None and _is_regular_file(output_file):
+        store_cache(chunks, cached)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
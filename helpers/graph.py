@@ -1,29 +1,76 @@
 # import re
+import numpy as np
 import pygame
 import math
 
 class Graph:
     def __init__(self, graph_matrix: list[list[float]]) -> None:
         self.m = len(graph_matrix)
-        self.col_index = []
-        self.row_index = [0]
-        self.values = []
+
+        # Keep the matrix two dimensional even when the graph has no nodes
+        arr = np.asarray(graph_matrix)
+        if arr.ndim != 2:
+            arr = arr.reshape(self.m, 0)
 
         # Convert to compressed sparse row format
-        for i in range(self.m):
-            for j in range(len(graph_matrix[i])):
-                if graph_matrix[i][j] != 0:
-                    self.col_index.append(j)
-                    self.values.append(graph_matrix[i][j])
-            self.row_index.append(len(self.col_index))
+        mask = arr != 0
+        self.row_index = np.concatenate(([0], np.cumsum(mask.sum(axis=1)))).astype(np.int32)
+        self.col_index = np.nonzero(mask)[1].astype(np.int32)
+        self.values = arr[mask]
+
+    @classmethod
+    def from_edges(cls, n: int, edges: list[tuple[int, int, int, int]]) -> 'Graph':
+        '''Build the graph straight from (a, b, weight, direction) edges without a matrix'''
+        a, b, w, d = np.array(edges, dtype=np.int64).reshape(-1, 4).T
+        seq = np.arange(len(a))
+
+        # Undirected edges go both ways and reversed edges go from b to a
+        both = d == 0
+        src = np.concatenate((np.where(d < 0, b, a), b[both]))
+        dst = np.concatenate((np.where(d < 0, a, b), a[both]))
+        w = np.concatenate((w, w[both]))
+        seq = np.concatenate((seq, seq[both]))
+
+        # Sort by row then column, later edges overwrite earlier ones like the matrix did
+        order = np.lexsort((seq, dst, src))
+        src, dst, w = src[order], dst[order], w[order]
+        last = np.append((src[1:] != src[:-1]) | (dst[1:] != dst[:-1]), True)
+        keep = last & (w != 0)
+        src, dst, w = src[keep], dst[keep], w[keep]
+
+        graph = cls.__new__(cls)
+        graph.m = n
+        graph.row_index = np.concatenate(([0], np.cumsum(np.bincount(src, minlength=n)))).astype(np.int32)
+        graph.col_index = dst.astype(np.int32)
+        graph.values = w
+        return graph
 
     def __str__(self):
         '''Print the graph in graphX ASM format'''
         result = ''
-        result += f'.row_index\n{", ".join(map(str, self.row_index))}\n\n'
-        result += f'.col_index\n{", ".join(map(str, self.col_index))}\n\n'
-        result += f'.values\n{", ".join(map(str, self.values))}\n\n'
+        result += f'.row_index\n{", ".join(self.row_index.astype(str))}\n\n'
+        result += f'.col_index\n{", ".join(self.col_index.astype(str))}\n\n'
+        result += f'.values\n{", ".join(self.values.astype(str))}\n\n'
         return result
+
+def dist_to_lines(p, v, w):
+    '''Calculate the squared distance from a point to each line segment v[i]-w[i]'''
+    p = np.asarray(p, dtype=np.float64)
+    v = np.asarray(v, dtype=np.float64)
+    w = np.asarray(w, dtype=np.float64)
+
+    # Distance of each line
+    vw = w - v
+    l2 = (vw**2).sum(axis=1)
+
+    # Found this on stack overflow, not sure exactly how it works
+    # https://stackoverflow.com/questions/849211/shortest-distance-between-a-point-and-a-line-segment
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = np.clip(((p - v) * vw).sum(axis=1) / l2, 0, 1)
+    # Reduces to a single point if length is 0
+    t[l2 == 0] = 0
+    proj = v + t[:, None] * vw
+    return ((p - proj)**2).sum(axis=1)
     
 def main():
     # Nodes and edges are just stored as a list of tuples
@@ -39,75 +86,92 @@ def main():
     # Used for adding edge weights
     weight_text = ''
     popup_rect = pygame.Rect(950, 475, 100, 50) # (100x50 centered in screen)
+    popup_background = pygame.Rect(925, 450, 150, 100)
+    popup_area = popup_background
     popup_active = False
     current_edge = -1
 
-    def intersect_point(x, y):
-        '''Get an intersecting node if it exists'''
-        target_node = -1
+    # Rendered text for edge weights and node IDs, keyed by the value shown
+    weight_labels = {}
+    node_labels = {}
 
-        for i in range(len(nodes)):
-            # Hash map is stored as entries with (index, x_pos, y_pos)
-            if (nodes[i][0] - x)**2 + (nodes[i][1] - y)**2 < 15**2:
-                target_node = i
-        return target_node
-    
-    def to_adjacency_matrix():
-        '''Convert the nodes and edges to an adjacency matrix'''
-        n = len(nodes)
-        matrix = [[0 for _ in range(n)] for _ in range(n)]
-        for a, b, w, direction in edges:
-            if direction == 0:
-                matrix[a][b] = w
-                matrix[b][a] = w
-            elif direction == 1:
-                matrix[a][b] = w
-            else:
-                matrix[b][a] = w
+    # Node positions as an (N, 2) array for vectorized hit tests, grown by doubling
+    node_xy = np.empty((16, 2), dtype=np.int32)
+
+    def add_node(pos):
+        '''Add a node to both the node list and the position array'''
+        nonlocal node_xy
+        if len(nodes) == len(node_xy):
+            node_xy = np.concatenate((node_xy, np.empty_like(node_xy)))
+        node_xy[len(nodes)] = pos
+        nodes.append(pos)
 
-        return matrix
+    def intersect_point(pos):
+        '''Get the closest intersecting node if it exists'''
+        if not nodes:
+            return -1
+
+        # Squared distance from every node at once
+        diff = node_xy[:len(nodes)] - pos
+        dist = np.einsum('ij,ij->i', diff, diff)
+        i = int(dist.argmin())
+        return i if dist[i] < 15**2 else -1
     
-    def dist_to_line(p, v, w):
-        '''Calculate the squared distance from a point to a line segment'''
-        # Distance of line
-        l2 = (v[0] - w[0])**2 + (v[1] - w[1])**2
-        if l2 == 0:
-            # Reduces to a single point if length is 0
-            return (p[0] - v[0])**2 + (p[1] - v[1])**2
-        
-        # Found this on stack overflow, not sure exactly how it works
-        # https://stackoverflow.com/questions/849211/shortest-distance-between-a-point-and-a-line-segment
-        t = ((p[0] - v[0]) * (w[0] - v[0]) + (p[1] - v[1]) * (w[1] - v[1])) / l2
-        t = max(0, min(1, t))
-        p2 = (v[0] + t * (w[0] - v[0]), v[1] + t * (w[1] - v[1]))
-        return (p[0] - p2[0])**2 + (p[1] - p2[1])**2
-
-    def closest_edge(x, y):
-        '''Find the closest edge to a position'''
-        min_edge = -1
-        min_dist = float('inf')
-        for i, (a, b, _, _) in enumerate(edges):
-            a = nodes[a]
-            b = nodes[b]
-            dist = dist_to_line((x, y), a, b)
+    # Edge endpoint indices as an (E, 2) array, rebuilt lazily after edges are added
+    edge_ends = None
 
-            if dist < min_dist:
-                min_dist = dist
-                min_edge = i
+    def closest_edge(pos):
+        '''Find the closest edge to a position'''
+        nonlocal edge_ends
+        if not edges:
+            return -1
+        if edge_ends is None:
+            edge_ends = np.array([(a, b) for a, b, _, _ in edges], dtype=np.intp)
 
-        return min_edge
+        dist = dist_to_lines(pos, node_xy[edge_ends[:, 0]], node_xy[edge_ends[:, 1]])
+        return int(dist.argmin())
 
     # Initialize pygame
     pygame.init()
     screen = pygame.display.set_mode((2000, 1000))
     running = True
     font = pygame.font.SysFont('Arial', 15)
+    clock = pygame.time.Clock()
+
+    # Only present a frame when something changed, and only the popup when just its text did
+    dirty = True
+    popup_dirty = False
+    last_mouse_pos = None
+
+    def render_circle(color, radius):
+        '''Render a filled circle once so it can be stamped with blits'''
+        surface = pygame.Surface((2*radius + 1, 2*radius + 1), pygame.SRCALPHA)
+        pygame.draw.circle(surface, color, (radius, radius), radius)
+        return surface.convert_alpha()
+
+    # Nodes and direction dots are stamped instead of rasterized every frame
+    node_surface = render_circle((0, 0, 0), 15)
+    dot_surface = render_circle((255, 0, 0), 5)
+
+    def render_label(cache, key, color):
+        '''Render a label once and reuse the surface on later frames'''
+        surface = cache.get(key)
+        if surface is None:
+            surface = font.render(str(key), True, color)
+            cache[key] = surface
+        return surface
 
     while running:
         '''Event loop'''
-        for event in pygame.event.get():
+        # Query the mouse once per frame, after the event queue has been pumped
+        events = pygame.event.get()
+        mouse_pos = pygame.mouse.get_pos()
+        for event in events:
             if event.type == pygame.QUIT:
                 running = False
+            elif event.type == pygame.VIDEOEXPOSE:
+                # Window contents were lost
+                dirty = True
             if popup_active:
                 if event.type == pygame.KEYDOWN:
                     # Typing in the input box
@@ -116,28 +180,32 @@ def main():
                         popup_active = False
                         e = edges[current_edge]
                         edges[current_edge] = (e[0], e[1], int(weight_text), e[3])
+                        dirty = True
                     elif event.key == pygame.K_BACKSPACE:
                         # Backspace input
                         weight_text = weight_text[:-1]
+                        popup_dirty = True
                     else:
                         # Default input
                         weight_text += event.unicode
+                        popup_dirty = True
             else:
                 if event.type == pygame.MOUSEBUTTONDOWN:
                     if event.button == 1:
                         # Left button click
-                        i = intersect_point(*event.pos)
+                        i = intersect_point(event.pos)
                         if i < 0:
                             # Not intersecting, add to nodes and spatial hash
-                            nodes.append((event.pos[0], event.pos[1]))
+                            add_node(event.pos)
                             current_node = len(nodes)-1
                         else:
                             # Intersecting, handle intersection
                             start = i
+                        dirty = True
                 elif event.type == pygame.MOUSEBUTTONUP:
                     if event.button == 1:
                         # Left button unclick
-                        i = intersect_point(*event.pos)
+                        i = intersect_point(event.pos)
                         if i < 0:
                             # Incorrect drag
                             start = -1
@@ -149,33 +217,55 @@ def main():
                             end = i
                             if start >= 0 and end >= 0:
                                 edges.append((start, end, 1, 0))
+                                edge_ends = None
                                 start, end = -1, -1
+                        dirty = True
                 elif event.type == pygame.KEYDOWN:
                     if event.key == pygame.K_s:
                         # Print out the graph in CSR format
-                        matrix = to_adjacency_matrix()
-                        print(matrix)
-                        graph = Graph(matrix)
+                        graph = Graph.from_edges(len(nodes), edges)
                         print(graph)
                     elif event.key == pygame.K_w:
                         # Add an edge weight
-                        current_edge = closest_edge(*pygame.mouse.get_pos())
+                        current_edge = closest_edge(mouse_pos)
                         weight_text = ''
                         popup_active = True
+                        dirty = True
                     elif event.key == pygame.K_e:
                         # Toggle edge from undirected to directed
-                        e = closest_edge(*pygame.mouse.get_pos())
+                        e = closest_edge(mouse_pos)
                         edge = edges[e]
                         new_direction = ((edge[3] + 2) % 3) - 1
                         edges[e] = (edge[0], edge[1], edge[2], new_direction)
-        
-        # White background
-        screen.fill((255, 255, 255))
+                        dirty = True
 
-        # Draw the edges first so the nodes show up in front of them
-        for a, b, w, d in edges:
-            pygame.draw.line(screen, (0, 0, 0), nodes[a], nodes[b], 2)
+        # The edge being drawn follows the mouse
+        if start >= 0 and mouse_pos != last_mouse_pos:
+            dirty = True
+        last_mouse_pos = mouse_pos
+
+        # Nothing changed, wait for the next frame without redrawing
+        if not (dirty or popup_dirty):
+            clock.tick(60)
+            continue
+
+        # Text is collected per frame and blitted in one batch
+        weight_blits = []
+        node_blits = []
 
+        # Primitives share one surface lock per run, blits need the surface unlocked
+        screen.lock()
+        try:
+            # White background
+            screen.fill((255, 255, 255))
+
+            # Draw the edges first so the nodes show up in front of them
+            for a, b, _, _ in edges:
+                pygame.draw.line(screen, (0, 0, 0), nodes[a], nodes[b], 2)
+        finally:
+            screen.unlock()
+
+        for a, b, w, d in edges:
             # Check for direction
             if d > 0:
                 dest = nodes[b]
@@ -192,44 +282,60 @@ def main():
                 vec = (src[0] - dest[0], src[1] - dest[1])
                 
                 # Calculate center
-                center = (dest[0] + 0.4*vec[0], dest[1] + 0.4*vec[1])
-                pygame.draw.circle(screen, (255, 0, 0), center, 5)
+                center = (int(dest[0] + 0.4*vec[0]), int(dest[1] + 0.4*vec[1]))
+                screen.blit(dot_surface, (center[0] - 5, center[1] - 5))
 
             # Put the edge weight on the center of the line
             line_center = ((nodes[a][0] + nodes[b][0]) // 2, (nodes[a][1] + nodes[b][1]) // 2)
-            text_surface = font.render(str(w), True, (0, 0, 0))
-            text_rect = text_surface.get_rect(center=line_center)
-            pygame.draw.rect(screen, (255, 255, 255), text_rect)
-            screen.blit(text_surface, text_rect)
+            text_surface = render_label(weight_labels, w, (0, 0, 0))
+            weight_blits.append((text_surface, text_surface.get_rect(center=line_center)))
+
+        # Edge weights go on top of every edge, each on a white background
+        screen.lock()
+        try:
+            for _, text_rect in weight_blits:
+                pygame.draw.rect(screen, (255, 255, 255), text_rect)
+        finally:
+            screen.unlock()
+        screen.blits(weight_blits, doreturn=False)
 
         # If the user is currently drawing an edge draw the edge as it's created
         if start >= 0:
-            pygame.draw.line(screen, (255, 0, 0), nodes[start], pygame.mouse.get_pos(), 2)
+            pygame.draw.line(screen, (255, 0, 0), nodes[start], mouse_pos, 2)
 
         # Draw the nodes
+        screen.blits([(node_surface, (x - 15, y - 15)) for x, y in nodes], doreturn=False)
         for i, (x, y) in enumerate(nodes):
-            pygame.draw.circle(screen, (0, 0, 0), (x, y), 15)
-
             # Put the node ID on the center of the node
-            text_surface = font.render(str(i), True, (255, 255, 255))
-            text_rect = text_surface.get_rect(center=(x, y))
-            screen.blit(text_surface, text_rect)
+            text_surface = render_label(node_labels, i, (255, 255, 255))
+            node_blits.append((text_surface, text_surface.get_rect(center=(x, y))))
+
+        screen.blits(node_blits, doreturn=False)
 
         # Draw the popup last so it overlays everything else
         if popup_active:
             # Draw popup background 
-            pygame.draw.rect(screen, (100, 100, 100), (925, 450, 150, 100)) # Input background
+            pygame.draw.rect(screen, (100, 100, 100), popup_background) # Input background
             pygame.draw.rect(screen, (255, 255, 255), popup_rect, 2) # Input box border
 
             # Render and blit input text
             text_surface = font.render(weight_text, True, (255, 255, 255))
-            screen.blit(text_surface, (popup_rect.x + 5, popup_rect.y + 5))
+            text_rect = screen.blit(text_surface, (popup_rect.x + 5, popup_rect.y + 5))
+
+            # Cover what the popup drew last frame as well as this one
+            last_popup_area = popup_area
+            popup_area = popup_background.unionall([popup_rect, text_rect])
 
             # Adjust weight width dynamically
             popup_rect.w = max(100, text_surface.get_width() + 10)
 
-        # Flip double buffers
-        pygame.display.flip()
+        if dirty:
+            # Flip double buffers
+            pygame.display.flip()
+        else:
+            # Only the popup text changed
+            pygame.display.update(popup_area.union(last_popup_area))
+        dirty = popup_dirty = False
 
 pygame.quit()
 